@@ -0,0 +1,231 @@
+"""
+Enriches a Mode webhook event once and then delivers the enriched payload
+to several sinks (Slack, a destination URL, the query run CSV log, ...)
+concurrently. This config is specific to running on the AWS Lambda service.
+
+The sinks to deliver to are read from the comma separated `sinks`
+environment variable (e.g. `slack,destination`), and the per-sink timeout,
+in seconds, from the `sink_timeout` environment variable. Each sink reads
+its own configuration (e.g. `slack_webhook_url`, `destination_url`).
+
+New sinks can be added by registering a function with the `sink` decorator:
+
+    @sink('my_sink')
+    def my_sink(event_name, event_url, payload, timeout):
+        ...
+
+"""
+import json
+import hookrich as hr
+import hooktrace as ht
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+
+log = logging.getLogger()
+log.setLevel(logging.INFO)
+
+
+DEFAULT_SINKS = 'slack'
+DEFAULT_SINK_TIMEOUT = 10
+
+SINKS = {}
+
+
+def _response(**resp):
+    """
+    Return an API Gateway compatible response.
+
+    """
+    return {'body': json.dumps(resp)}
+
+
+def sink(name):
+    """
+    Register a function as a delivery sink under the given name.
+
+    """
+    def register(func):
+        SINKS[name] = func
+        return func
+
+    return register
+
+
+@sink('slack')
+def slack_sink(event_name, event_url, payload, timeout):
+    """
+    Post the enriched payload to Slack.
+
+    """
+    import post_to_slack
+
+    if event_name not in post_to_slack.MESSAGE_EVENTS:
+        return 'skipped'
+
+    return post_to_slack.send_to_slack(event_name, payload, timeout=timeout)
+
+
+@sink('destination')
+def destination_sink(event_name, event_url, payload, timeout):
+    """
+    POST the enriched payload to the destination URL.
+
+    """
+    import post_to_destination
+
+    return post_to_destination.send_to_destination(payload, timeout=timeout)
+
+
+@sink('query_run_log')
+def query_run_log_sink(event_name, event_url, payload, timeout):
+    """
+    Log the query runs of a completed report run to the CSV file.
+
+    """
+    import log_usage_csv
+
+    if event_name != 'report_run_completed':
+        return 'skipped'
+
+    log_usage_csv.log_to_csv(log_usage_csv.get_queries_info(event_url))
+
+    return 'logged'
+
+
+def configured_sinks():
+    """
+    Return the names of the sinks listed in the `sinks` environment variable.
+
+    """
+    names = os.environ.get('sinks', DEFAULT_SINKS).split(',')
+    return [name.strip() for name in names if name.strip()]
+
+
+def _timed(name, parent, func, *args):
+    """
+    Call a sink, traced under the `parent` span of the delivering thread, and
+    return its result along with the elapsed time in seconds.
+
+    """
+    started_at = time.time()
+
+    with ht.span('sink', parent=parent, sink=name):
+        result = func(*args)
+
+    return result, time.time() - started_at
+
+
+def deliver(event_name, event_url, payload, sinks=None, timeout=None):
+    """
+    Deliver an enriched payload to every sink concurrently.
+
+    A failing or slow sink never affects the other sinks. Returns a metrics
+    dictionary per sink with its result and duration.
+
+    """
+    if sinks is None:
+        sinks = configured_sinks()
+    if timeout is None:
+        timeout = float(os.environ.get('sink_timeout', DEFAULT_SINK_TIMEOUT))
+
+    metrics = {}
+    futures = {}
+    executor = ThreadPoolExecutor(max_workers=max(len(sinks), 1))
+    parent = ht.current_span()
+    started_at = time.time()
+
+    for name in sinks:
+        if name not in SINKS:
+            metrics[name] = {'result': 'error', 'message': 'Unknown sink: {}'.format(name)}
+            continue
+
+        futures[executor.submit(_timed, name, parent, SINKS[name], event_name, event_url, payload, timeout)] = name
+
+    done, not_done = wait(futures, timeout=timeout)
+
+    for future in done:
+        name = futures[future]
+        try:
+            response, duration = future.result()
+        except Exception as error:
+            log.error('Sink {} failed: {}'.format(name, error))
+            metrics[name] = {'result': 'error', 'message': str(error),
+                             'duration': time.time() - started_at}
+        else:
+            metrics[name] = {'result': 'success', 'response': response, 'duration': duration}
+
+    for future in not_done:
+        name = futures[future]
+        log.error('Sink {} timed out after {} seconds'.format(name, timeout))
+        metrics[name] = {'result': 'timeout', 'duration': timeout}
+
+    # Don't wait on timed out sinks, their threads finish in the background
+    executor.shutdown(wait=False)
+
+    log.info('Sink metrics: {}'.format(json.dumps(metrics, default=str)))
+
+    return metrics
+
+
+def fan_out(event_name, event_url, sinks=None, deadline=None):
+    """
+    Enrich the event once and deliver it to every sink.
+
+    """
+    payload = hr.enrich_payload(event_name, event_url, deadline=deadline)
+    payload['event_name'] = event_name
+
+    timeout = None
+    if deadline is not None:
+        timeout = min(float(os.environ.get('sink_timeout', DEFAULT_SINK_TIMEOUT)), deadline.delivery_timeout())
+
+    return deliver(event_name, event_url, payload, sinks=sinks, timeout=timeout)
+
+
+def lambda_function_handler(event, context):
+    """
+    AWS Lambda entry point.
+
+    """
+    with ht.invocation('fan_out', context):
+        return handle_event(event, context)
+
+
+def handle_event(event, context):
+    """
+    Handle a webhook event delivered through API Gateway.
+
+    """
+    log.info('Received payload {}'.format(event))
+
+    with ht.span('parse'):
+        try:
+            body = json.loads(event['body'])
+            event_name = body['event']
+        except (TypeError, KeyError):
+            msg = "Invalid webhook event: {}".format(event)
+            log.error(msg)
+            return _response(result='error', message=msg)
+
+        try:
+            event_url = body[hr.WEBHOOK_EVENTS[event_name]['url']]
+        except KeyError:
+            msg = "Unsupported event type: {}".format(event_name)
+            log.error(msg)
+            return _response(result='error', message=msg)
+
+    try:
+        # No deadline when the handler is called directly, without a Lambda context
+        deadline = hr.Deadline.from_context(context) if context is not None else None
+        metrics = fan_out(event_name, event_url, deadline=deadline)
+    except Exception as error:
+        log.error(str(error))
+        return _response(result='error', message=str(error))
+
+    if any(metric['result'] != 'success' for metric in metrics.values()):
+        return _response(result='partial', sinks=metrics)
+
+    return _response(result='success', sinks=metrics)
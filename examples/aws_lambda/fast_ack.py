@@ -0,0 +1,460 @@
+"""
+Acknowledges Mode webhooks immediately and enriches them in the background.
+
+The `lambda_function_handler` entry point only validates the webhook event
+and persists it to a durable queue before returning, so Mode never waits on
+the Mode API or the destinations. A separate worker (`drain`, or running this
+module as a script) receives events from the queue, enriches them once and
+delivers them to the sinks configured for the `fan_out` module.
+
+The queue is selected with environment variables:
+
+    queue_url           an SQS queue URL (requires boto3), required on
+                        AWS Lambda
+    queue_path          otherwise, the path of a local SQLite queue
+                        (defaults to /tmp/webhook_events.db), a stand-in
+                        for running the handler and the worker locally
+
+and the worker is configured with `worker_concurrency`,
+`visibility_timeout` (seconds) and `max_receives` (deliveries before an
+event is dead-lettered).
+
+Delivery is at least once: an event is only removed from the queue after it
+was processed, and it is received again when a worker fails or doesn't
+finish within the visibility timeout. Failed events are retried with an
+exponential backoff, and only to the sinks they weren't delivered to yet,
+which are recorded in a delivery ledger (a SQLite table next to the local
+queue, or the `ledger_path` database for SQS).
+
+"""
+import json
+import hookrich as hr
+import hooktrace as ht
+import fan_out
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+
+log = logging.getLogger()
+log.setLevel(logging.INFO)
+
+
+DEFAULT_QUEUE_PATH = '/tmp/webhook_events.db'
+DEFAULT_LEDGER_PATH = '/tmp/webhook_deliveries.db'
+DEFAULT_CONCURRENCY = 4
+DEFAULT_VISIBILITY_TIMEOUT = 60
+DEFAULT_MAX_RECEIVES = 5
+
+# Seconds of the visibility timeout kept free for delivering an event
+# after enriching it
+DELIVERY_RESERVE = 10
+
+POLL_INTERVAL = 1
+
+# Seconds before a failed event is retried, doubled on every receive
+RETRY_DELAY = 5
+MAX_RETRY_DELAY = 300
+
+
+Message = namedtuple('Message', ['id', 'body', 'receive_count', 'receipt'])
+
+
+class QueueNotConfigured(Exception):
+    pass
+
+
+class DeliveryFailed(Exception):
+    """
+    Raised when an event couldn't be delivered to some of the sinks.
+
+    """
+
+    def __init__(self, delivered, failed):
+        super(DeliveryFailed, self).__init__('Delivery failed for sink(s): {}'.format(', '.join(sorted(failed))))
+        self.delivered = delivered
+        self.failed = failed
+
+
+class _SQLiteStore(object):
+    """
+    Base of the SQLite backed stores, with one connection per thread.
+
+    """
+
+    def _connection(self):
+        """
+        Return this thread's connection to the database.
+
+        """
+        connection = getattr(self._local, 'connection', None)
+
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute('PRAGMA synchronous=FULL')
+            self._local.connection = connection
+
+        return connection
+
+
+class DeliveryLedger(_SQLiteStore):
+    """
+    Record of the sinks each queued event was already delivered to, so that
+    a retry doesn't post to them again.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+        connection = self._connection()
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('CREATE TABLE IF NOT EXISTS deliveries ('
+                           'message_id TEXT NOT NULL, sink TEXT NOT NULL, PRIMARY KEY (message_id, sink))')
+
+    def delivered(self, message_id):
+        rows = self._connection().execute(
+            'SELECT sink FROM deliveries WHERE message_id = ?', (str(message_id),)).fetchall()
+
+        return set(sink for sink, in rows)
+
+    def record(self, message_id, sinks):
+        self._connection().executemany(
+            'INSERT OR IGNORE INTO deliveries (message_id, sink) VALUES (?, ?)',
+            [(str(message_id), sink) for sink in sinks])
+
+    def forget(self, message_id):
+        self._connection().execute('DELETE FROM deliveries WHERE message_id = ?', (str(message_id),))
+
+
+class SQLiteQueue(_SQLiteStore):
+    """
+    Durable local queue, backed by a SQLite database in WAL mode, with the
+    semantics of an SQS queue: received messages are hidden for a visibility
+    timeout and have to be acknowledged, and messages received more than
+    `max_receives` times are moved to a dead-letter table.
+
+    """
+
+    def __init__(self, path, max_receives=DEFAULT_MAX_RECEIVES):
+        self.path = path
+        self.max_receives = max_receives
+        self._local = threading.local()
+        self.ledger = DeliveryLedger(path)
+
+        connection = self._connection()
+        connection.execute('CREATE TABLE IF NOT EXISTS messages ('
+                           'id INTEGER PRIMARY KEY AUTOINCREMENT, body TEXT NOT NULL, '
+                           'enqueued_at REAL NOT NULL, visible_at REAL NOT NULL, '
+                           'receive_count INTEGER NOT NULL DEFAULT 0)')
+        connection.execute('CREATE INDEX IF NOT EXISTS messages_visible_at ON messages (visible_at)')
+        connection.execute('CREATE TABLE IF NOT EXISTS dead_letters ('
+                           'id INTEGER PRIMARY KEY, body TEXT NOT NULL, enqueued_at REAL NOT NULL, '
+                           'receive_count INTEGER NOT NULL, dead_lettered_at REAL NOT NULL)')
+
+    def put(self, body):
+        now = time.time()
+        cursor = self._connection().execute(
+            'INSERT INTO messages (body, enqueued_at, visible_at) VALUES (?, ?, ?)', (body, now, now))
+
+        return cursor.lastrowid
+
+    def receive(self, max_messages, visibility_timeout):
+        """
+        Receive up to `max_messages` visible messages and hide them for
+        `visibility_timeout` seconds.
+
+        """
+        connection = self._connection()
+        now = time.time()
+        messages = []
+
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            rows = connection.execute(
+                'SELECT id, body, enqueued_at, receive_count FROM messages '
+                'WHERE visible_at <= ? ORDER BY id LIMIT ?', (now, max_messages)).fetchall()
+
+            for message_id, body, enqueued_at, receive_count in rows:
+                if receive_count >= self.max_receives:
+                    log.error('Dead-lettering message {} after {} receives'.format(message_id, receive_count))
+                    connection.execute(
+                        'INSERT INTO dead_letters (id, body, enqueued_at, receive_count, dead_lettered_at) '
+                        'VALUES (?, ?, ?, ?, ?)', (message_id, body, enqueued_at, receive_count, now))
+                    connection.execute('DELETE FROM messages WHERE id = ?', (message_id,))
+                    connection.execute('DELETE FROM deliveries WHERE message_id = ?', (str(message_id),))
+                    continue
+
+                connection.execute(
+                    'UPDATE messages SET visible_at = ?, receive_count = ? WHERE id = ?',
+                    (now + visibility_timeout, receive_count + 1, message_id))
+                messages.append(Message(message_id, body, receive_count + 1, (message_id, receive_count + 1)))
+
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+
+        return messages
+
+    def ack(self, message):
+        """
+        Delete a processed message. Does nothing if the message was received
+        again by another worker in the meantime.
+
+        """
+        message_id, receive_count = message.receipt
+        deleted = self._connection().execute(
+            'DELETE FROM messages WHERE id = ? AND receive_count = ?', (message_id, receive_count)).rowcount
+
+        if deleted:
+            self.ledger.forget(message_id)
+
+    def release(self, message, delay=0):
+        """
+        Make a message visible again after `delay` seconds.
+
+        """
+        message_id, receive_count = message.receipt
+        self._connection().execute(
+            'UPDATE messages SET visible_at = ? WHERE id = ? AND receive_count = ?',
+            (time.time() + delay, message_id, receive_count))
+
+
+class SQSQueue(object):
+    """
+    Queue backed by Amazon SQS. Dead-lettering is handled by the redrive
+    policy configured on the queue.
+
+    """
+
+    def __init__(self, queue_url, ledger_path=DEFAULT_LEDGER_PATH):
+        import boto3
+
+        self.queue_url = queue_url
+        self.client = boto3.client('sqs')
+        self.ledger = DeliveryLedger(ledger_path)
+
+    def put(self, body):
+        return self.client.send_message(QueueUrl=self.queue_url, MessageBody=body)['MessageId']
+
+    def receive(self, max_messages, visibility_timeout):
+        response = self.client.receive_message(
+            QueueUrl=self.queue_url,
+            MaxNumberOfMessages=min(max_messages, 10),
+            VisibilityTimeout=int(visibility_timeout),
+            WaitTimeSeconds=POLL_INTERVAL,
+            AttributeNames=['ApproximateReceiveCount']
+        )
+
+        return [
+            Message(message['MessageId'], message['Body'],
+                    int(message['Attributes']['ApproximateReceiveCount']), message['ReceiptHandle'])
+            for message in response.get('Messages', [])
+        ]
+
+    def ack(self, message):
+        self.client.delete_message(QueueUrl=self.queue_url, ReceiptHandle=message.receipt)
+        self.ledger.forget(message.id)
+
+    def release(self, message, delay=0):
+        self.client.change_message_visibility(
+            QueueUrl=self.queue_url, ReceiptHandle=message.receipt, VisibilityTimeout=int(delay))
+
+
+def open_queue():
+    """
+    Open the queue configured by the environment.
+
+    On AWS Lambda, `/tmp` only lives as long as the container and no worker
+    drains it, so a local queue would lose the events it acknowledged.
+
+    """
+    if os.environ.get('queue_url'):
+        return SQSQueue(os.environ['queue_url'], ledger_path=os.environ.get('ledger_path', DEFAULT_LEDGER_PATH))
+
+    if os.environ.get('AWS_LAMBDA_FUNCTION_NAME'):
+        raise QueueNotConfigured('queue_url must be set to queue webhook events on AWS Lambda')
+
+    return SQLiteQueue(os.environ.get('queue_path', DEFAULT_QUEUE_PATH),
+                       max_receives=int(os.environ.get('max_receives', DEFAULT_MAX_RECEIVES)))
+
+
+_queue = None
+
+
+def _get_queue():
+    """
+    Return the queue of this Lambda container, opened on first use.
+
+    """
+    global _queue
+
+    if _queue is None:
+        _queue = open_queue()
+
+    return _queue
+
+
+def _response(**resp):
+    """
+    Return an API Gateway compatible response.
+
+    """
+    return {'body': json.dumps(resp)}
+
+
+def process_event(body, visibility_timeout=DEFAULT_VISIBILITY_TIMEOUT, delivered=()):
+    """
+    Enrich a queued webhook event and deliver it to the configured sinks it
+    wasn't `delivered` to yet. Raises `DeliveryFailed` when some of the
+    sinks failed.
+
+    Enrichment has to finish before the message becomes visible again.
+
+    """
+    sinks = [name for name in fan_out.configured_sinks() if name not in delivered]
+    if not sinks:
+        return
+
+    body = json.loads(body)
+    event_name = body['event']
+    event_url = body[hr.WEBHOOK_EVENTS[event_name]['url']]
+    deadline = hr.Deadline(visibility_timeout - DELIVERY_RESERVE, reserve=DELIVERY_RESERVE)
+
+    metrics = fan_out.fan_out(event_name, event_url, sinks=sinks, deadline=deadline)
+
+    succeeded = set(name for name, metric in metrics.items() if metric['result'] == 'success')
+    if succeeded != set(sinks):
+        raise DeliveryFailed(succeeded, set(sinks) - succeeded)
+
+
+def retry_delay(receive_count):
+    """
+    Return the seconds to wait before retrying an event after its
+    `receive_count`th receive failed.
+
+    """
+    return min(RETRY_DELAY * 2 ** (receive_count - 1), MAX_RETRY_DELAY)
+
+
+def _work(queue, process, visibility_timeout, stats, stats_lock, forever):
+    """
+    Process messages one at a time until the queue is empty.
+
+    """
+    while True:
+        messages = queue.receive(1, visibility_timeout)
+
+        if not messages:
+            if not forever:
+                return
+            time.sleep(POLL_INTERVAL)
+            continue
+
+        message = messages[0]
+
+        try:
+            with ht.span('process_event', message_id=message.id, receive_count=message.receive_count):
+                process(message.body, visibility_timeout, queue.ledger.delivered(message.id))
+        except Exception as error:
+            if isinstance(error, DeliveryFailed):
+                queue.ledger.record(message.id, error.delivered)
+
+            delay = retry_delay(message.receive_count)
+            log.error('Failed to process message {} (receive {}), retrying in {}s: {}'.format(
+                message.id, message.receive_count, delay, error))
+            queue.release(message, delay)
+            result = 'failed'
+        else:
+            queue.ack(message)
+            result = 'processed'
+
+        with stats_lock:
+            stats[result] += 1
+
+
+def drain(queue=None, process=process_event, concurrency=None, visibility_timeout=None, forever=False):
+    """
+    Process the queued events with `concurrency` worker threads. `process`
+    is called with the event body, the visibility timeout and the sinks the
+    event was already delivered to.
+
+    Returns when no event is visible, or never when `forever` is set. Failed
+    events are made visible again after `retry_delay` seconds and are
+    dead-lettered once they were received `max_receives` times.
+
+    """
+    if queue is None:
+        queue = open_queue()
+    if concurrency is None:
+        concurrency = int(os.environ.get('worker_concurrency', DEFAULT_CONCURRENCY))
+    if visibility_timeout is None:
+        visibility_timeout = float(os.environ.get('visibility_timeout', DEFAULT_VISIBILITY_TIMEOUT))
+
+    stats = {'processed': 0, 'failed': 0}
+    stats_lock = threading.Lock()
+
+    workers = [
+        threading.Thread(target=_work, args=(queue, process, visibility_timeout, stats, stats_lock, forever))
+        for _ in range(concurrency)
+    ]
+
+    for worker in workers:
+        worker.start()
+
+    for worker in workers:
+        worker.join()
+
+    log.info('Drained queue: {}'.format(stats))
+
+    return stats
+
+
+def lambda_function_handler(event, context):
+    """
+    AWS Lambda entry point. Validates the webhook event and queues it.
+
+    """
+    with ht.invocation('fast_ack', context):
+        return handle_event(event, context)
+
+
+def handle_event(event, context):
+    """
+    Validate a webhook event delivered through API Gateway and queue it.
+
+    """
+    try:
+        body = json.loads(event['body'])
+        event_name = body['event']
+    except (TypeError, KeyError, ValueError):
+        msg = "Invalid webhook event: {}".format(event)
+        log.error(msg)
+        return _response(result='error', message=msg)
+
+    if event_name not in hr.WEBHOOK_EVENTS or hr.WEBHOOK_EVENTS[event_name]['url'] not in body:
+        msg = "Unsupported event type: {}".format(event_name)
+        log.error(msg)
+        return _response(result='error', message=msg)
+
+    # Not acknowledging is better than losing the event, so a missing queue
+    # fails the invocation
+    queue = _get_queue()
+
+    try:
+        message_id = queue.put(event['body'])
+    except Exception as error:
+        log.error(str(error))
+        return _response(result='error', message=str(error))
+
+    return _response(result='queued', id=message_id)
+
+
+if __name__ == '__main__':
+    logging.basicConfig()
+    drain(forever=True)
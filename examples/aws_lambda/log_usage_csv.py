@@ -1,17 +1,16 @@
 """
-Lambda function for logging report runs to a CSV file.
+Lambda function for logging report runs to a CSV file. The file is appended
+to at the `csv_path` environment variable, which defaults to a file in
+`/tmp` since the deployment package directory is read-only on Lambda.
 
 """
-import os
-import requests
 import json
 import csv
-from requests.auth import HTTPBasicAuth
+import hookrich as hr
+import os
 
 
-# Read environment variables
-token = os.environ['api_token']
-password = os.environ['api_password']
+DEFAULT_CSV_PATH = '/tmp/query_runs.csv'
 
 
 def lambda_handler(event, context):
@@ -36,13 +35,12 @@ def get_queries_info(run_url):
 
     """
     query_runs_url = run_url + '/query_runs'
-    queries_req = requests.get(query_runs_url, auth=HTTPBasicAuth(token, password))
-    queries_res = queries_req.json()
+    queries_res = hr.mode_api_get(query_runs_url)
     columns_list = ["query_token", "state", "created_at", "completed_at", "raw_source", "parameters"]
     data = []
 
     for query in queries_res['_embedded']['query_runs']:
-        row = [ query[col].encode("utf-8").replace('\n', ' ').replace('    ', '') if col == 'raw_source' else str(query[col]).encode("utf-8")
+        row = [ query[col].replace('\n', ' ').replace('    ', '') if col == 'raw_source' else str(query[col])
                 for col in columns_list ]
         data.append(row)
 
@@ -54,7 +52,7 @@ def log_to_csv(queries_info):
     Write to CSV.
 
     """
-    with open('file_name.csv', 'a') as f:
+    with open(os.environ.get('csv_path', DEFAULT_CSV_PATH), 'a', newline='') as f:
         writer = csv.writer(f)
 
         for line in queries_info:
@@ -0,0 +1,352 @@
+"""
+Runs a Lambda handler across worker processes, routing every webhook event
+to a worker by a stable key. With `--key org`, all the events of an
+organization go to the same worker, so its entity index and Mode API
+connections stay warm in one process, at the cost of uneven load when a few
+organizations send most events. With `--key report` (the default), the key
+also includes the report token of report events, which spreads an
+organization across the workers: the events of a report still stay on one
+worker, but every worker keeps its own copy of the organization's index and
+connections.
+
+The `rate_limit` of each organization in `mode_credentials`, and the
+overall `--rate-limit`, are shared by all the workers, so they hold however
+the organizations are spread.
+
+Keys are assigned to workers with consistent hashing, so adding or removing
+a worker only moves the keys of that worker's share of the ring. The load
+of each partition is logged every `--report-every` events and at the end.
+
+    python partition.py --handler post_to_destination --workers 8 --key org events/*.jsonl
+
+"""
+import argparse
+import bisect
+import hashlib
+import hookrich as hr
+import json
+import logging
+import multiprocessing
+import replay
+from collections import Counter, defaultdict
+from queue import Empty
+
+
+log = logging.getLogger('partition')
+
+
+# Points of each worker on the hash ring. More points spread the keys
+# more evenly across the workers.
+DEFAULT_REPLICAS = 100
+
+# Seconds to wait for a result before checking that the workers are alive
+RESULT_TIMEOUT = 1
+
+# Events submitted between two reports of the load of the partitions
+REPORT_INTERVAL = 1000
+
+
+def _hash(value):
+    return int(hashlib.md5(value.encode('utf-8')).hexdigest()[:16], 16)
+
+
+class HashRing(object):
+    """
+    Consistent hash ring mapping keys to nodes.
+
+    """
+
+    def __init__(self, nodes=(), replicas=DEFAULT_REPLICAS):
+        self.replicas = replicas
+        self._points = []
+        self._nodes = {}
+
+        for node in nodes:
+            self.add_node(node)
+
+    def add_node(self, node):
+        for replica in range(self.replicas):
+            point = _hash('{}:{}'.format(node, replica))
+            bisect.insort(self._points, point)
+            self._nodes[point] = node
+
+    def remove_node(self, node):
+        for replica in range(self.replicas):
+            point = _hash('{}:{}'.format(node, replica))
+            self._points.remove(point)
+            del self._nodes[point]
+
+    def get_node(self, key):
+        """
+        Return the node owning a key: the first node clockwise of its hash.
+
+        """
+        if not self._points:
+            raise ValueError('The hash ring has no nodes')
+
+        index = bisect.bisect(self._points, _hash(key)) % len(self._points)
+        return self._nodes[self._points[index]]
+
+    @property
+    def nodes(self):
+        return set(self._nodes.values())
+
+
+def partition_key(body, by='report'):
+    """
+    Return the partition key of a webhook body: its organization, followed,
+    when partitioning `by` report, by its report token for report events.
+
+    """
+    event_name = body['event']
+    event_url = hr.EventURL(body[hr.WEBHOOK_EVENTS[event_name]['url']])
+
+    if by == 'report' and event_url.report_token:
+        return '{}/{}'.format(event_url.org, event_url.report_token)
+
+    return event_url.org
+
+
+def _run_worker(name, handler_name, events, results, timeout, rate_limiter, org_rate_limiters):
+    """
+    Process the events routed to a worker until it receives None.
+
+    """
+    replay.init_worker(handler_name, rate_limiter, timeout, False)
+
+    # Replace the per-process limits of the organizations with shared ones
+    for org, org_rate_limiter in org_rate_limiters.items():
+        hr.get_client(org).rate_limiter = org_rate_limiter
+
+    while True:
+        line = events.get()
+        if line is None:
+            break
+
+        path, line_number, line, error = replay.replay_event(('', 0, line))
+        results.put((name, error))
+
+
+class PartitionedExecutor(object):
+    """
+    Pool of worker processes running a Lambda handler, each processing the
+    events of the keys assigned to it on a consistent hash ring.
+
+    """
+
+    def __init__(self, handler_name, workers, replicas=DEFAULT_REPLICAS, timeout=900, key='report',
+                 rate_limit=None):
+        replay.load_handler(handler_name)
+
+        self.handler_name = handler_name
+        self.timeout = timeout
+        self.key = key
+        self.rate_limiter = replay.SharedRateLimiter(rate_limit) if rate_limit else None
+        self.org_rate_limiters = {
+            org: replay.SharedRateLimiter(credentials['rate_limit'])
+            for org, credentials in hr.load_credentials().items()
+            if credentials.get('rate_limit')
+        }
+        self.ring = HashRing(replicas=replicas)
+        self.results = multiprocessing.Queue()
+        self._workers = {}
+        self._next_worker = 0
+
+        # Processes of the workers on the ring and of the removed workers
+        # still processing their events
+        self._processes = {}
+
+        self.submitted = Counter()
+        self.completed = Counter()
+        self.errors = Counter()
+        self.keys = defaultdict(set)
+
+        for _ in range(workers):
+            self.add_worker()
+
+    def add_worker(self):
+        """
+        Start a worker and take over its share of the keys.
+
+        """
+        name = 'worker-{}'.format(self._next_worker)
+        self._next_worker += 1
+
+        events = multiprocessing.Queue()
+        process = multiprocessing.Process(target=_run_worker,
+                                          args=(name, self.handler_name, events, self.results, self.timeout,
+                                                self.rate_limiter, self.org_rate_limiters))
+        process.start()
+
+        self._workers[name] = (process, events)
+        self._processes[name] = process
+        self.ring.add_node(name)
+
+        return name
+
+    def remove_worker(self, name):
+        """
+        Hand the keys of a worker over to the others. The worker exits once
+        it has processed the events already routed to it.
+
+        """
+        self.ring.remove_node(name)
+        process, events = self._workers.pop(name)
+        self.keys.pop(name, None)
+        events.put(None)
+
+        return process
+
+    def _reap(self):
+        """
+        Take the workers that died off the ring, counting the events routed
+        to them that weren't processed as errors.
+
+        """
+        dead = [name for name, process in self._processes.items() if not process.is_alive()]
+        if not dead:
+            return
+
+        # Results a worker sent before exiting are still in the queue
+        self._collect(block=False)
+
+        for name in dead:
+            process = self._processes.pop(name)
+            lost = self.submitted[name] - self.completed[name]
+
+            if lost:
+                log.error('{} exited with code {} before processing {} event(s)'.format(name, process.exitcode, lost))
+                self.completed[name] += lost
+                self.errors[name] += lost
+
+            if name in self._workers:
+                self.ring.remove_node(name)
+                self.keys.pop(name, None)
+                _, events = self._workers.pop(name)
+                # Don't block on exit flushing events nobody will read
+                events.cancel_join_thread()
+
+    def submit(self, line):
+        """
+        Route a webhook event, one line of JSON, to the worker owning its key.
+        Raises a `RuntimeError` once every worker has died.
+
+        """
+        event = json.loads(line)
+        body = json.loads(event['body']) if 'body' in event else event
+
+        self._reap()
+        if not self._workers:
+            raise RuntimeError('No worker is alive')
+
+        key = partition_key(body, by=self.key)
+        name = self.ring.get_node(key)
+
+        self.keys[name].add(key)
+        self.submitted[name] += 1
+        self._workers[name][1].put(line)
+
+        self._collect(block=False)
+
+        return name
+
+    def _collect(self, block):
+        """
+        Record the results of the processed events. With `block`, wait for
+        every submitted event to be processed, or its worker to die.
+
+        """
+        while sum(self.completed.values()) < sum(self.submitted.values()):
+            try:
+                name, error = self.results.get(block=block, timeout=RESULT_TIMEOUT if block else None)
+            except Empty:
+                if not block:
+                    return
+
+                self._reap()
+                continue
+
+            self.completed[name] += 1
+
+            if error is not None:
+                self.errors[name] += 1
+                log.error('{}: {}'.format(name, error))
+
+    def load(self):
+        """
+        Return the load of each partition: its number of distinct keys and
+        of events submitted, completed and failed.
+
+        """
+        return {
+            name: {
+                'keys': len(self.keys[name]),
+                'events': self.submitted[name],
+                'completed': self.completed[name],
+                'errors': self.errors[name]
+            }
+            for name in sorted(self.submitted)
+        }
+
+    def close(self):
+        """
+        Wait for every event to be processed and stop the workers.
+
+        """
+        self._collect(block=True)
+
+        for process, events in self._workers.values():
+            events.put(None)
+
+        for process in self._processes.values():
+            process.join()
+
+
+def log_load(executor):
+    for name, load in executor.load().items():
+        log.info('{}: {keys} keys, {events} events, {completed} completed, {errors} errors'.format(name, **load))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Process Mode webhook events across partitioned workers.')
+    parser.add_argument('paths', nargs='+', help='JSONL files of webhook events')
+    parser.add_argument('--handler', required=True,
+                        help='module of the Lambda handler, e.g. post_to_destination')
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(),
+                        help='number of worker processes')
+    parser.add_argument('--replicas', type=int, default=DEFAULT_REPLICAS,
+                        help='points of each worker on the hash ring')
+    parser.add_argument('--key', choices=('org', 'report'), default='report',
+                        help='partition the events by organization, or by organization and report')
+    parser.add_argument('--rate-limit', type=float,
+                        help='maximum Mode API calls per second, across all workers')
+    parser.add_argument('--report-every', type=int, default=REPORT_INTERVAL,
+                        help='number of events between two reports of the load')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s %(name)s %(levelname)s %(message)s')
+    log.setLevel(logging.INFO)
+
+    executor = PartitionedExecutor(args.handler, args.workers, replicas=args.replicas, key=args.key,
+                                   rate_limit=args.rate_limit)
+    submitted = 0
+
+    try:
+        for path, line_number, line in replay.read_events(args.paths, {}):
+            try:
+                executor.submit(line)
+            except (ValueError, KeyError) as error:
+                log.error('{}:{}: invalid webhook event: {}'.format(path, line_number + 1, error))
+                continue
+
+            submitted += 1
+            if submitted % args.report_every == 0:
+                log_load(executor)
+    finally:
+        executor.close()
+
+    log_load(executor)
+
+
+if __name__ == '__main__':
+    main()
@@ -8,6 +8,7 @@ The URL is read from the `destination_url` environment variable.
 import requests
 import json
 import hookrich as hr
+import hooktrace as ht
 import logging
 import os
 
@@ -24,15 +25,26 @@ def _response(**resp):
     return {'body': json.dumps(resp)}
 
 
-def post_to_destination(event_name, event_url):
+def send_to_destination(payload, timeout=None):
+    """
+    POST an already enriched payload to the destination URL.
+
+    """
+    with ht.span('post', destination='destination'):
+        return requests.post(os.environ['destination_url'], data=hr.payload_to_dict(payload), timeout=timeout).json()
+
+
+def post_to_destination(event_name, event_url, deadline=None):
     """
     Call the destination URL with event details.
 
     """
-    payload = hr.enrich_payload(event_name, event_url)
+    payload = hr.enrich_payload(event_name, event_url, deadline=deadline)
     payload['event_name'] = event_name
 
-    return requests.post(os.environ['destination_url'], data=payload).json()
+    timeout = deadline.delivery_timeout() if deadline is not None else None
+
+    return send_to_destination(payload, timeout=timeout)
 
 
 def lambda_function_handler(event, context):
@@ -40,25 +52,37 @@ def lambda_function_handler(event, context):
     AWS Lambda entry point.
 
     """
-    log.info("Received payload: {}".format(event))
+    with ht.invocation('post_to_destination', context):
+        return handle_event(event, context)
 
-    try:
-        body = json.loads(event['body'])
-        event_name = body['event']
-    except (TypeError, KeyError):
-        msg = "Invalid webhook event: {}".format(event)
-        log.error(msg)
-        return _response(result='error', message=msg)
 
-    try:
-        event_url = body[hr.WEBHOOK_EVENTS[event_name]['url']]
-    except KeyError:
-        msg = "Unsupported event type: {}".format(event_name)
-        log.error(msg)
-        return _response(result='error', message=msg)
+def handle_event(event, context):
+    """
+    Handle a webhook event delivered through API Gateway.
+
+    """
+    log.info("Received payload: {}".format(event))
+
+    with ht.span('parse'):
+        try:
+            body = json.loads(event['body'])
+            event_name = body['event']
+        except (TypeError, KeyError):
+            msg = "Invalid webhook event: {}".format(event)
+            log.error(msg)
+            return _response(result='error', message=msg)
+
+        try:
+            event_url = body[hr.WEBHOOK_EVENTS[event_name]['url']]
+        except KeyError:
+            msg = "Unsupported event type: {}".format(event_name)
+            log.error(msg)
+            return _response(result='error', message=msg)
 
     try:
-        response = post_to_destination(event_name, event_url)
+        # No deadline when the handler is called directly, without a Lambda context
+        deadline = hr.Deadline.from_context(context) if context is not None else None
+        response = post_to_destination(event_name, event_url, deadline=deadline)
     except Exception as error:
         log.error(str(error))
         return _response(result='error', message=str(error))
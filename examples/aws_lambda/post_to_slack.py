@@ -9,6 +9,7 @@ The Slack webhook URL is read from the `slack_webhook_url` environment variable.
 import requests
 import json
 import hookrich as hr
+import hooktrace as ht
 import logging
 import os
 
@@ -23,6 +24,16 @@ alerts = {
     'threshold': 1000
 }
 
+# Events a Slack message is built for by `build_slack_message`
+MESSAGE_EVENTS = (
+    'report_run_completed',
+    'report_created',
+    'member_joined_organization',
+    'definition_created',
+    'definition_updated',
+    'new_database_connection'
+)
+
 
 def _response(**resp):
     """
@@ -32,6 +43,20 @@ def _response(**resp):
     return {'body': json.dumps(resp)}
 
 
+def _space_phrase(payload):
+    """
+    Describe the space of a report, or nothing if the space details were
+    dropped to meet the enrichment deadline.
+
+    """
+    space = payload.get('space')
+
+    if not space:
+        return ''
+
+    return ' in the <{}|{}> space'.format(space['url'], space['name'])
+
+
 def definition_created_message(payload):
     """
     Build a Slack notification about a new definition.
@@ -155,11 +180,9 @@ def report_created_message(payload):
     report_url = payload['report']['url']
     report_name = payload['report']['name']
     report_creator = payload['report']['creator']
-    space_name = payload['space']['name']
-    space_url = payload['space']['url']
 
-    message = '{} just created the <{}|{}> report in the <{}|{}> space.'
-    message = message.format(report_creator, report_url, report_name, space_url, space_name)
+    message = '{} just created the <{}|{}> report{}.'
+    message = message.format(report_creator, report_url, report_name, _space_phrase(payload))
 
     attachments = [
         {
@@ -183,44 +206,67 @@ def report_run_completed_message(payload):
     report_url = payload['report']['url']
     report_name = payload['report']['name']
     report_run_executor = payload['report_run']['executed_by']
-    space_name = payload['space']['name']
-    space_url = payload['space']['url']
+    space_phrase = _space_phrase(payload)
+
+    # The alert can't be checked when the results were dropped to meet the
+    # enrichment deadline
+    alert_row = None
+    is_alert_report = payload['report_run']['state'] == 'succeeded' and payload['report']['id'] == alerts['report_id']
+    alert_unchecked = is_alert_report and 'results' in payload.get('dropped_sections', [])
 
-    if payload['report_run']['state'] == 'succeeded' and payload['report']['id'] == alerts['report_id']:
+    if is_alert_report and not alert_unchecked:
 
         for row in payload['report_run']['results']:
             if row[alerts['field']] > alerts['threshold']:
+                alert_row = row
+                break
 
-                message = 'Heads up! {} just ran the <{}|{}> report in the <{}|{}> space and it succeeded, but the {} field exceeded the alert threshold.'
-                message = message.format(report_run_executor, report_url, report_name, space_url, space_name, alerts['field'])
+    if alert_row is not None:
+        message = 'Heads up! {} just ran the <{}|{}> report{} and it succeeded, but the {} field exceeded the alert threshold.'
+        message = message.format(report_run_executor, report_url, report_name, space_phrase, alerts['field'])
 
-                attachments = [
+        attachments = [
+            {
+                'fallback': message,
+                'color': 'warning',
+                'author_name': 'Mode',
+                'author_link': 'https://modeanalytics.com/',
+                'title': 'Threshold Alert :heavy_exclamation_mark:',
+                'text': message,
+                'fields': [
+                    {
+                        'title': 'Observed Value',
+                        'value': alert_row[alerts['field']]
+                    },
                     {
-                        'fallback': message,
-                        'color': 'warning',
-                        'author_name': 'Mode',
-                        'author_link': 'https://modeanalytics.com/',
-                        'title': 'Threshold Alert :heavy_exclamation_mark:',
-                        'text': message,
-                        'fields': [
-                            {
-                                'title': 'Observed Value',
-                                'value': row[alerts['field']]
-                            },
-                            {
-                                'title': 'Threshold Value',
-                                'value': alerts['threshold']
-                            }
-                        ]
+                        'title': 'Threshold Value',
+                        'value': alerts['threshold']
                     }
                 ]
-                break
+            }
+        ]
+
+    elif alert_unchecked:
+        message = ('Heads up! {} just ran the <{}|{}> report{} and it succeeded, but its results could not be '
+                   'loaded in time to check the {} field against the alert threshold.')
+        message = message.format(report_run_executor, report_url, report_name, space_phrase, alerts['field'])
+
+        attachments = [
+            {
+                'fallback': message,
+                'color': 'warning',
+                'author_name': 'Mode',
+                'author_link': 'https://modeanalytics.com/',
+                'title': 'Threshold Alert Not Checked :grey_question:',
+                'text': message
+            }
+        ]
 
     elif payload['report_run']['state'] == 'succeeded':
         report_run_duration = payload['report_run']['execution_duration']
 
-        message = 'Good news! {} just ran the <{}|{}> report in the <{}|{}> space and it succeeded. It took {} seconds to run.'
-        message = message.format(report_run_executor, report_url, report_name, space_url, space_name, report_run_duration)
+        message = 'Good news! {} just ran the <{}|{}> report{} and it succeeded. It took {} seconds to run.'
+        message = message.format(report_run_executor, report_url, report_name, space_phrase, report_run_duration)
 
         attachments = [
             {
@@ -236,8 +282,11 @@ def report_run_completed_message(payload):
     elif payload['report_run']['state'] == 'failed':
         report_consecutive_run_failures = payload['report']['consecutive_run_failures']
 
-        message = 'Oh no! {} just ran the <{}|{}> report in the <{}|{}> space and it failed. It has failed the last {} run(s).'
-        message = message.format(report_run_executor, report_url, report_name, space_url, space_name, report_consecutive_run_failures)
+        message = 'Oh no! {} just ran the <{}|{}> report{} and it failed.'
+        message = message.format(report_run_executor, report_url, report_name, space_phrase)
+
+        if report_consecutive_run_failures is not None:
+            message += ' It has failed the last {} run(s).'.format(report_consecutive_run_failures)
 
         attachments = [
             {
@@ -274,24 +323,38 @@ def build_slack_message(event_name, payload):
         raise Exception("Unsupported event type: {}".format(event_name))
 
 
-def post_to_slack(event_name, event_url):
+def send_to_slack(event_name, payload, timeout=None):
     """
-    Post event details to Slack.
+    Post an already enriched payload to Slack.
 
     """
-    payload = hr.enrich_payload(event_name, event_url)
-    payload['event_name'] = event_name
+    with ht.span('build_slack_message'):
+        slack_attachments = build_slack_message(event_name, payload)
 
-    slack_attachments = build_slack_message(event_name, payload)
     slack_payload = {
         'attachments': slack_attachments,
         'username': 'Mode'
     }
 
-    return requests.post(
-               os.environ['slack_webhook_url'],
-               json=slack_payload
-           ).text
+    with ht.span('post', destination='slack'):
+        return requests.post(
+                   os.environ['slack_webhook_url'],
+                   json=slack_payload,
+                   timeout=timeout
+               ).text
+
+
+def post_to_slack(event_name, event_url, deadline=None):
+    """
+    Post event details to Slack.
+
+    """
+    payload = hr.enrich_payload(event_name, event_url, deadline=deadline)
+    payload['event_name'] = event_name
+
+    timeout = deadline.delivery_timeout() if deadline is not None else None
+
+    return send_to_slack(event_name, payload, timeout=timeout)
 
 
 def lambda_function_handler(event, context):
@@ -299,25 +362,37 @@ def lambda_function_handler(event, context):
     AWS Lambda entry point.
 
     """
-    log.info('Received payload {}'.format(event))
+    with ht.invocation('post_to_slack', context):
+        return handle_event(event, context)
 
-    try:
-        body = json.loads(event['body'])
-        event_name = body['event']
-    except (TypeError, KeyError):
-        msg = "Invalid webhook event: {}".format(event)
-        log.error(msg)
-        return _response(result='error', message=msg)
 
-    try:
-        event_url = body[hr.WEBHOOK_EVENTS[event_name]['url']]
-    except KeyError:
-        msg = "Unsupported event type: {}".format(event_name)
-        log.error(msg)
-        return _response(result='error', message=msg)
+def handle_event(event, context):
+    """
+    Handle a webhook event delivered through API Gateway.
+
+    """
+    log.info('Received payload {}'.format(event))
+
+    with ht.span('parse'):
+        try:
+            body = json.loads(event['body'])
+            event_name = body['event']
+        except (TypeError, KeyError):
+            msg = "Invalid webhook event: {}".format(event)
+            log.error(msg)
+            return _response(result='error', message=msg)
+
+        try:
+            event_url = body[hr.WEBHOOK_EVENTS[event_name]['url']]
+        except KeyError:
+            msg = "Unsupported event type: {}".format(event_name)
+            log.error(msg)
+            return _response(result='error', message=msg)
 
     try:
-        response = post_to_slack(event_name, event_url)
+        # No deadline when the handler is called directly, without a Lambda context
+        deadline = hr.Deadline.from_context(context) if context is not None else None
+        response = post_to_slack(event_name, event_url, deadline=deadline)
     except Exception as error:
         log.error(str(error))
         return _response(result='error', message=str(error))
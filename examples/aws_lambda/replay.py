@@ -0,0 +1,265 @@
+"""
+Replays archived Mode webhook events through one of the Lambda handlers,
+e.g. to backfill a new destination or to rerun `log_usage_csv`.
+
+Events are streamed from JSONL files, one webhook body (or one API Gateway
+event with a `body`) per line, and dispatched across a pool of worker
+processes. Each worker keeps its own pool of connections to the Mode API,
+while the rate of Mode API calls is limited across all the workers. Run it
+from the deployment package directory of the handler:
+
+    python replay.py --handler post_to_destination --workers 8 \\
+        --rate-limit 20 --checkpoint replay.checkpoint events/*.jsonl
+
+With `--checkpoint`, the number of events replayed from each file is saved
+as the replay progresses, and a rerun with the same checkpoint resumes
+where the previous one stopped. Events that fail are appended to the
+`--retry-file` (by default, the checkpoint path followed by `.failed.jsonl`)
+before the checkpoint moves past them, so they can be replayed on their own:
+
+    python replay.py --handler post_to_destination replay.checkpoint.failed.jsonl
+
+"""
+import argparse
+import importlib
+import json
+import logging
+import multiprocessing
+import os
+import time
+import uuid
+
+
+log = logging.getLogger('replay')
+
+
+CHECKPOINT_INTERVAL = 100
+PROGRESS_INTERVAL = 1000
+
+
+class SharedRateLimiter(object):
+    """
+    Limit the rate of calls, across processes, to `rate` per second.
+
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.next_at = multiprocessing.Value('d', 0.0)
+
+    def acquire(self):
+        with self.next_at.get_lock():
+            now = time.time()
+            call_at = max(now, self.next_at.value)
+            self.next_at.value = call_at + self.interval
+
+        if call_at > now:
+            time.sleep(call_at - now)
+
+
+class ReplayContext(object):
+    """
+    Stand-in for the Lambda context passed to the handlers.
+
+    """
+
+    def __init__(self, timeout):
+        self.aws_request_id = uuid.uuid4().hex
+        self.expires_at = time.time() + timeout
+
+    def get_remaining_time_in_millis(self):
+        return max(int((self.expires_at - time.time()) * 1000), 0)
+
+
+_handler = None
+_timeout = None
+
+
+def load_handler(handler_name):
+    """
+    Import a handler module and return its Lambda entry point.
+
+    """
+    module = importlib.import_module(handler_name)
+    return getattr(module, 'lambda_function_handler', None) or module.lambda_handler
+
+
+def init_worker(handler_name, rate_limiter, timeout, verbose):
+    """
+    Import the handler and set up the Mode API session of a worker process.
+
+    """
+    global _handler, _timeout
+
+    import hookrich as hr
+
+    _handler = load_handler(handler_name)
+    _timeout = timeout
+
+    hr.reset_clients()
+    hr.RATE_LIMITER = rate_limiter
+
+    # The handlers log every event at INFO level
+    if not verbose:
+        logging.disable(logging.INFO)
+
+
+def replay_event(item):
+    """
+    Dispatch an archived event through the handler. Returns the item along
+    with None on success, or the error message otherwise.
+
+    """
+    path, line_number, line = item
+
+    try:
+        event = json.loads(line)
+        if 'body' not in event:
+            event = {'body': line}
+
+        body = _handler(event, ReplayContext(_timeout))['body']
+    except Exception as error:
+        return path, line_number, line, str(error)
+
+    try:
+        response = json.loads(body)
+    except ValueError:
+        response = {'result': body}
+
+    if response.get('result') not in ('success', 'queued'):
+        return path, line_number, line, response.get('message') or json.dumps(response)
+
+    return path, line_number, line, None
+
+
+def load_checkpoint(path):
+    if path and os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+
+    return {}
+
+
+def save_checkpoint(path, checkpoint):
+    """
+    Atomically write the checkpoint.
+
+    """
+    temp_path = path + '.tmp'
+
+    with open(temp_path, 'w') as f:
+        json.dump(checkpoint, f)
+
+    os.rename(temp_path, path)
+
+
+def read_events(paths, checkpoint):
+    """
+    Yield `(path, line_number, line)` for every event not replayed yet.
+
+    """
+    for path in paths:
+        skip = checkpoint.get(path, 0)
+
+        with open(path) as f:
+            for line_number, line in enumerate(f):
+                if line_number < skip or not line.strip():
+                    continue
+
+                yield path, line_number, line
+
+
+def replay(paths, handler_name, workers=None, rate_limit=None, checkpoint_path=None,
+           timeout=900, verbose=False, retry_path=None):
+    """
+    Replay the events of the JSONL files at `paths` through a handler,
+    appending the events that fail to the JSONL file at `retry_path`.
+
+    Returns the number of events replayed and of errors.
+
+    """
+    if retry_path is None and checkpoint_path:
+        retry_path = checkpoint_path + '.failed.jsonl'
+
+    # A failing pool initializer is retried forever, so import the handler
+    # here first to fail fast
+    load_handler(handler_name)
+
+    rate_limiter = SharedRateLimiter(rate_limit) if rate_limit else None
+    checkpoint = load_checkpoint(checkpoint_path)
+    stats = {'events': 0, 'errors': 0}
+    started_at = time.time()
+
+    pool = multiprocessing.Pool(workers, initializer=init_worker,
+                                initargs=(handler_name, rate_limiter, timeout, verbose))
+    retry_file = open(retry_path, 'a') if retry_path else None
+
+    try:
+        # Results come back in order, so every event before the one just
+        # returned has been replayed, or saved for retry, and can be
+        # checkpointed
+        for path, line_number, line, error in pool.imap(replay_event, read_events(paths, checkpoint), chunksize=4):
+            stats['events'] += 1
+
+            if error is not None:
+                stats['errors'] += 1
+                log.error('{}:{}: {}'.format(path, line_number + 1, error))
+
+                if retry_file:
+                    retry_file.write(line if line.endswith('\n') else line + '\n')
+
+            checkpoint[path] = line_number + 1
+
+            if checkpoint_path and stats['events'] % CHECKPOINT_INTERVAL == 0:
+                if retry_file:
+                    retry_file.flush()
+                save_checkpoint(checkpoint_path, checkpoint)
+
+            if stats['events'] % PROGRESS_INTERVAL == 0:
+                log.info('Replayed {events} events ({errors} errors), {rate:.1f} events/s'.format(
+                    rate=stats['events'] / (time.time() - started_at), **stats))
+    finally:
+        pool.terminate()
+
+        if retry_file:
+            retry_file.close()
+
+        if checkpoint_path:
+            save_checkpoint(checkpoint_path, checkpoint)
+
+    stats['seconds'] = time.time() - started_at
+    stats['events_per_second'] = stats['events'] / stats['seconds'] if stats['seconds'] else 0.0
+
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay archived Mode webhook events through a Lambda handler.')
+    parser.add_argument('paths', nargs='+', help='JSONL files of archived webhook events')
+    parser.add_argument('--handler', required=True,
+                        help='module of the Lambda handler, e.g. post_to_destination')
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(),
+                        help='number of worker processes')
+    parser.add_argument('--rate-limit', type=float,
+                        help='maximum Mode API calls per second, across all workers')
+    parser.add_argument('--checkpoint', help='file to save progress to and resume from')
+    parser.add_argument('--retry-file',
+                        help='JSONL file the failed events are appended to (default: <checkpoint>.failed.jsonl)')
+    parser.add_argument('--timeout', type=float, default=900,
+                        help='seconds each event may take, as the Lambda timeout would')
+    parser.add_argument('--verbose', action='store_true', help='log every event')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s %(name)s %(levelname)s %(message)s')
+    log.setLevel(logging.INFO)
+
+    stats = replay(args.paths, args.handler, workers=args.workers, rate_limit=args.rate_limit,
+                   checkpoint_path=args.checkpoint, timeout=args.timeout, verbose=args.verbose,
+                   retry_path=args.retry_file)
+
+    log.info('Replayed {events} events with {errors} errors in {seconds:.1f}s '
+             '({events_per_second:.1f} events/s)'.format(**stats))
+
+
+if __name__ == '__main__':
+    main()
@@ -5,13 +5,116 @@ about the event. This "enriched" payload can then be used in a POST to
 other services (e.g. Slack, Zapier, Gmail, etc.)
 
 """
+import hooktrace as ht
+import json
+import logging
+import operator
 import os.path
 import requests
+import threading
+import time
 from datetime import datetime
 
 
+log = logging.getLogger(__name__)
+
+
 MODE_BASE_URL = 'https://modeanalytics.com/'
 
+# Org-level list endpoints used to warm the entity index, keyed by the
+# name of the collection in the `_embedded` section of their response
+PREFETCH_COLLECTIONS = {
+    'spaces': 'spaces?filter=all',
+    'memberships': 'memberships?embed[user]=1',
+    'data_sources': 'data_sources'
+}
+
+# Seconds a background prefetch may take, independently of the deadline of
+# the event that triggered it
+PREFETCH_TIMEOUT = 60
+
+# Seconds to wait before retrying a failed prefetch, doubled after every
+# consecutive failure
+PREFETCH_RETRY_DELAY = 30
+PREFETCH_MAX_RETRY_DELAY = 900
+
+# Seconds to keep free, when deriving a deadline from the Lambda context,
+# for delivering the enriched payload. The reserve never takes more than
+# DEADLINE_RESERVE_SHARE of the time left, so short Lambda timeouts (3
+# seconds by default) still leave time for enrichment.
+DEADLINE_RESERVE = 3
+DEADLINE_RESERVE_SHARE = 0.3
+
+# Upper bound, in seconds, of a single Mode API call made under a deadline
+REQUEST_TIMEOUT = 10
+
+# Seconds that must be left before the deadline to attempt fetching an
+# optional section, capped at OPTIONAL_SECTION_SHARE of the deadline's whole
+# budget so that short budgets still fetch them. Sections are skipped (and
+# listed in the payload's `dropped_sections`) when less time remains, or
+# when fetching them times out.
+OPTIONAL_SECTIONS = {
+    'results': 2,
+    'consecutive_run_failures': 2,
+    'space': 1
+}
+OPTIONAL_SECTION_SHARE = 0.2
+
+# Default size of the connection pool to the Mode API of an organization
+POOL_SIZE = 10
+
+# Optional object with an `acquire()` method, called before every Mode API
+# request, of any organization, to limit their rate
+RATE_LIMITER = None
+
+# Clients of the organizations served by this process, keyed by org
+_clients = {}
+_clients_lock = threading.Lock()
+
+# Per-thread state of the event being enriched: its organization, the number
+# of Mode API calls made, its deadline and the optional sections dropped
+_event = threading.local()
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class Deadline(object):
+    """
+    Point in time by which enrichment has to be finished.
+
+    """
+
+    def __init__(self, seconds, reserve=0):
+        self.budget = seconds
+        self.expires_at = time.time() + seconds
+        self.reserve = reserve
+
+    @classmethod
+    def from_context(cls, context, reserve=DEADLINE_RESERVE):
+        """
+        Derive a deadline from the remaining time of a Lambda invocation,
+        keeping part of it free for delivery.
+
+        """
+        remaining = context.get_remaining_time_in_millis() / 1000.0
+        reserve = min(reserve, remaining * DEADLINE_RESERVE_SHARE)
+
+        return cls(remaining - reserve, reserve=reserve)
+
+    def remaining(self):
+        return max(self.expires_at - time.time(), 0)
+
+    def delivery_timeout(self):
+        """
+        Return the seconds left for delivering the payload: the time left
+        before the deadline and the reserve kept after it.
+
+        """
+        return self.remaining() + self.reserve
+
+
 WEBHOOK_EVENTS = {
     'report_created': {
         'url': 'report_url',
@@ -76,16 +179,358 @@ class EventURL(object):
     def org(self):
         return self.path.split('/')[1]
 
+    @property
+    def report_token(self):
+        if '/reports/' not in self.path:
+            return None
+
+        return self.path.split('/reports/')[1].split('/')[0]
+
+
+class RateLimiter(object):
+    """
+    Limit the rate of calls, across threads, to `rate` per second.
+
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.next_at = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = time.time()
+            call_at = max(now, self.next_at)
+            self.next_at = call_at + self.interval
+
+        if call_at > now:
+            time.sleep(call_at - now)
+
+
+class OrgClient(object):
+    """
+    Mode API client of one organization, with its own credentials,
+    connection pool, rate limit and entity index, so that a busy
+    organization can't starve the others.
 
-def _mode_api_get(endpoint_url):
+    """
+
+    def __init__(self, org, api_token, api_password, rate_limit=None, pool_size=POOL_SIZE):
+        self.org = org
+        self.auth = (api_token, api_password)
+        self.rate_limiter = RateLimiter(rate_limit) if rate_limit else None
+        self.pool_size = pool_size
+        self.session = None
+
+        # Raw API responses keyed by their endpoint URL
+        self.entity_index = {}
+        self.index_warmed_at = None
+
+        # Only one thread prefetches at a time, and failed prefetches are
+        # retried after a backoff
+        self.prefetch_lock = threading.Lock()
+        self.prefetch_failures = 0
+        self.prefetch_retry_at = 0
+
+    def get(self, endpoint_url, timeout=None):
+        """
+        Send a GET request to a Mode API endpoint.
+
+        """
+        if self.session is None:
+            self.session = requests.Session()
+            self.session.mount(MODE_BASE_URL, requests.adapters.HTTPAdapter(pool_connections=1,
+                                                                            pool_maxsize=self.pool_size))
+
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+
+        return self.session.get(endpoint_url, auth=self.auth, timeout=timeout).json()
+
+
+def load_credentials():
+    """
+    Read the credentials of each organization from the `mode_credentials`
+    environment variable, a JSON object keyed by org:
+
+        {"org": {"api_token": ..., "api_password": ..., "rate_limit": 10, "pool_size": 10}}
+
+    `rate_limit` (requests per second) and `pool_size` are optional.
+    Organizations missing from it use the `api_token` and `api_password`
+    environment variables.
+
+    """
+    return json.loads(os.environ.get('mode_credentials', '{}'))
+
+
+def get_client(org):
+    """
+    Return the Mode API client of an organization.
+
+    """
+    client = _clients.get(org)
+
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(org)
+
+            if client is None:
+                config = load_credentials().get(org)
+
+                if config is None:
+                    client = OrgClient(org, os.environ['api_token'], os.environ['api_password'])
+                else:
+                    client = OrgClient(org, config['api_token'], config['api_password'],
+                                       rate_limit=config.get('rate_limit'),
+                                       pool_size=config.get('pool_size', POOL_SIZE))
+
+                _clients[org] = client
+
+    return client
+
+
+def reset_clients():
+    """
+    Discard every client, e.g. in a newly forked worker process that must
+    not share connections with its parent.
+
+    """
+    with _clients_lock:
+        _clients.clear()
+
+
+def _current_client(endpoint_url):
+    """
+    Return the client of the organization of the event being enriched, or
+    else of the organization in the endpoint URL.
+
+    """
+    org = getattr(_event, 'org', None)
+
+    if org is None:
+        org = EventURL(endpoint_url).org
+
+    return get_client(org)
+
+
+def _mode_api_get(endpoint_url, embed=()):
     """
     Send a GET request to a Mode API endpoint.
 
+    Related resources named in `embed` are requested with `embed[<name>]`
+    parameters and, where the endpoint supports it, returned in the
+    `_embedded` section of the response.
+
+    """
+    endpoint_url = str(endpoint_url)
+
+    if embed:
+        separator = '&' if '?' in endpoint_url else '?'
+        endpoint_url += separator + '&'.join('embed[{}]=1'.format(name) for name in embed)
+
+    deadline = getattr(_event, 'deadline', None)
+    timeout = None
+
+    if deadline is not None:
+        timeout = min(REQUEST_TIMEOUT, deadline.remaining())
+        if not timeout:
+            raise DeadlineExceeded('Deadline exceeded before requesting {}'.format(endpoint_url))
+
+    if RATE_LIMITER is not None:
+        RATE_LIMITER.acquire()
+
+    _event.api_calls = api_call_count() + 1
+    client = _current_client(endpoint_url)
+
+    with ht.span('mode_api_get', url=endpoint_url, org=client.org):
+        return client.get(endpoint_url, timeout=timeout)
+
+
+def mode_api_get(endpoint_url):
+    """
+    Send a GET request to a Mode API endpoint, with the same rate limit,
+    deadline, tracing and per-organization credentials as the enrichment.
+
+    """
+    return _mode_api_get(endpoint_url)
+
+
+def api_call_count():
+    """
+    Return the number of Mode API calls made by this thread since the last
+    call to `reset_api_call_count`.
+
+    """
+    return getattr(_event, 'api_calls', 0)
+
+
+def reset_api_call_count():
+    _event.api_calls = 0
+
+
+def _optional_section(name, default, func, *args):
+    """
+    Fetch an optional section of the payload, unless the deadline is too
+    close to do so. Returns `default` when the section is dropped.
+
+    """
+    deadline = getattr(_event, 'deadline', None)
+
+    if deadline is None:
+        return func(*args)
+
+    threshold = min(OPTIONAL_SECTIONS[name], deadline.budget * OPTIONAL_SECTION_SHARE)
+
+    if deadline.remaining() >= threshold:
+        try:
+            return func(*args)
+        except (DeadlineExceeded, requests.exceptions.Timeout):
+            pass
+
+    _event.dropped_sections.append(name)
+
+    return default
+
+
+def _embedded(data, name):
+    """
+    Return a resource embedded in an API response, or None if the endpoint
+    didn't embed it.
+
+    """
+    if not data:
+        return None
+
+    return data.get('_embedded', {}).get(name)
+
+
+def _mode_api_get_pages(url, max_pages=None):
+    """
+    Yield every page of a paginated Mode API endpoint.
+
+    """
+    data = _mode_api_get(url)
+    yield data
+
+    if 'pagination' not in data:
+        return
+
+    total_pages = data['pagination']['total_pages']
+    if max_pages is not None:
+        total_pages = min(total_pages, max_pages)
+
+    while data['pagination']['page'] < total_pages:
+        data = _mode_api_get(MODE_BASE_URL + data['_links']['next_page']['href'].lstrip('/'))
+        yield data
+
+
+def _entity_url(entity):
+    """
+    Return the API endpoint URL of an entity from its `self` link.
+
+    """
+    return MODE_BASE_URL + entity['_links']['self']['href'].lstrip('/').split('?')[0]
+
+
+def _index_entity(client, entity):
+    """
+    Add an entity, and any user embedded in it, to the entity index of an
+    organization.
+
+    """
+    client.entity_index[_entity_url(entity)] = entity
+
+    user = entity.get('_embedded', {}).get('user')
+    if user:
+        client.entity_index[_entity_url(user)] = user
+
+
+@ht.traced
+def prefetch_entities(organization):
+    """
+    Warm the entity index from the org-level list endpoints.
+
+    The organization itself, its spaces, memberships (with their users) and
+    connections are loaded with one paginated listing each instead of one
+    request per entity.
+
+    """
+    client = get_client(organization)
+
+    _index_entity(client, _mode_api_get(os.path.join(MODE_BASE_URL, 'api', organization)))
+
+    for collection, endpoint in PREFETCH_COLLECTIONS.items():
+        url = os.path.join(MODE_BASE_URL, 'api', organization, endpoint)
+
+        for page in _mode_api_get_pages(url):
+            for entity in page.get('_embedded', {}).get(collection, []):
+                _index_entity(client, entity)
+
+    client.index_warmed_at = time.time()
+
+
+def _prefetch_in_background(client):
+    """
+    Prefetch the entities of a client's organization under its own deadline,
+    backing off after failures.
+
+    """
+    _event.deadline = Deadline(PREFETCH_TIMEOUT)
+    reset_api_call_count()
+
+    try:
+        prefetch_entities(client.org)
+    except Exception as error:
+        client.prefetch_failures += 1
+        delay = min(PREFETCH_RETRY_DELAY * 2 ** (client.prefetch_failures - 1), PREFETCH_MAX_RETRY_DELAY)
+        client.prefetch_retry_at = time.time() + delay
+        log.warning('Could not prefetch entities for {}, retrying in {}s: {}'.format(client.org, delay, error))
+    else:
+        client.prefetch_failures = 0
+        log.info('Prefetched entities for {} with {} Mode API call(s)'.format(client.org, api_call_count()))
+    finally:
+        _event.deadline = None
+        client.prefetch_lock.release()
+
+
+def warm_entity_index(organization, max_age):
     """
-    return requests.get(
-               endpoint_url,
-               auth=(os.environ['api_token'], os.environ['api_password'])
-           ).json()
+    Start prefetching the organization's entities in a background thread,
+    unless they were loaded less than `max_age` seconds ago, another thread
+    is already prefetching them, or the last prefetch failed too recently.
+
+    Returns the prefetching thread, if one was started.
+
+    """
+    client = get_client(organization)
+    now = time.time()
+
+    if client.index_warmed_at is not None and now - client.index_warmed_at <= max_age:
+        return None
+
+    if now < client.prefetch_retry_at or not client.prefetch_lock.acquire(False):
+        return None
+
+    thread = threading.Thread(target=_prefetch_in_background, args=(client,))
+    thread.daemon = True
+    thread.start()
+
+    return thread
+
+
+def _mode_api_get_entity(endpoint_url, embed=()):
+    """
+    Look an entity up in the entity index, falling back to a GET request
+    to its Mode API endpoint.
+
+    """
+    entity = _current_client(endpoint_url).entity_index.get(str(endpoint_url).split('?')[0])
+
+    if entity is None:
+        entity = _mode_api_get(endpoint_url, embed=embed)
+
+    return entity
 
 
 def datetime_iso_convert(iso_string):
@@ -103,6 +548,7 @@ def report_run_duration(started_at, completed_at):
     return (report_run_completed_at - report_run_created_at).seconds
 
 
+@ht.traced
 def consecutive_run_failures(url):
     """
     Count the number of consecutive report run failures.
@@ -131,112 +577,271 @@ def get_report_runs(url):
     Retrieve report run metadata.
 
     """
-    report_runs_data = _mode_api_get(url + '/runs')
-
-    # Pagination
-    total_pages = report_runs_data['pagination']['total_pages']
     max_pagination_pages = 10
 
-    payload = [report_runs_data]
+    return list(_mode_api_get_pages(url + '/runs', max_pagination_pages))
 
-    while report_runs_data['pagination']['page'] < min(total_pages, max_pagination_pages):
-        report_runs_data = _mode_api_get(MODE_BASE_URL + report_runs_data['_links']['next_page']['href'])
-        payload.append(report_runs_data)
 
-    return payload
+def _fields(*names, **computed):
+    """
+    Map the fields of a model to the function reading them from the source
+    JSON: plain keys are read as is, others are computed.
+
+    """
+    fields = {name: operator.itemgetter(name) for name in names}
+    fields.update(computed)
+
+    return fields
 
 
-def get_report_run_info(url):
+def _link(name, start=0, split=None, index=None):
+    """
+    Return a function reading the href of a link, optionally sliced or
+    split on a separator.
+
+    """
+    def read(data):
+        href = data['_links'][name]['href'][start:]
+        return href.split(split)[index] if split is not None else href
+
+    return read
+
+
+def _links(name):
+    return lambda data: data['_links'][name]
+
+
+# Marks the fields that aren't read from the source JSON but passed to the
+# model when it is created
+PROVIDED = None
+
+
+class Model(object):
+    """
+    Compact, read-only view of a Mode API resource. Fields are read from the
+    source JSON the first time they are accessed and kept in slots, instead
+    of copying every field into a new dictionary.
+
+    Models can be read like the dictionaries they replace (`model['name']`,
+    `model.get('name')`, `model.keys()`), and `to_dict()` converts them to a
+    plain dictionary. Fields missing from the source JSON, or not provided,
+    are left out.
+
+    """
+    __slots__ = ('_data',)
+
+    FIELDS = {}
+
+    def __init__(self, data, **provided):
+        self._data = data
+
+        for name, value in provided.items():
+            setattr(self, name, value)
+
+    def __getattr__(self, name):
+        # Only called for fields that haven't been read yet
+        fields = type(self).FIELDS
+
+        if name not in fields or fields[name] is PROVIDED:
+            raise AttributeError(name)
+
+        value = fields[name](self._data)
+        setattr(self, name, value)
+
+        return value
+
+    def __getitem__(self, name):
+        if name not in self.FIELDS:
+            raise KeyError(name)
+
+        try:
+            return getattr(self, name)
+        except AttributeError:
+            raise KeyError(name)
+
+    def __setitem__(self, name, value):
+        if name not in self.FIELDS:
+            raise KeyError(name)
+
+        setattr(self, name, value)
+
+    def __contains__(self, name):
+        # A field is present when it can be read, as with `get`
+        try:
+            self[name]
+        except KeyError:
+            return False
+
+        return True
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __repr__(self):
+        return '{}({!r})'.format(type(self).__name__, self.to_dict())
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return [name for name in self.FIELDS if name in self]
+
+    def items(self):
+        return [(name, self[name]) for name in self.keys()]
+
+    def to_dict(self):
+        return dict(self.items())
+
+
+class ReportRun(Model):
+    FIELDS = _fields(
+        'state', 'parameters', 'python_state', 'created_at', 'completed_at', 'form_fields', 'token',
+        executed_by=_link('executed_by', split='/', index=2),
+        account=_links('account'),
+        share=_links('share'),
+        report=_links('report'),
+        query_runs=_links('query_runs'),
+        python_cell_runs=_links('python_cell_runs'),
+        execution_duration=lambda data: report_run_duration(data['created_at'], data['completed_at']),
+        results=PROVIDED,
+        url=_link('web_external_url', split='?', index=0)
+    )
+    __slots__ = tuple(FIELDS)
+
+
+class Report(Model):
+    FIELDS = _fields(
+        'name', 'id', 'created_at', 'edited_at', 'theme_id', 'archived', 'account_id', 'account_username',
+        'full_width', 'manual_run_disabled', 'run_privately', 'is_embedded', 'is_signed', 'shared',
+        'last_successfully_run_at', 'last_successful_run_token', 'last_run_at', 'description', 'public',
+        'space_token', 'web_preview_image',
+        creator=_link('creator', split='/', index=2),
+        consecutive_run_failures=PROVIDED,
+        report_schedules=_links('report_schedules'),
+        report_subscriptions=_links('report_subscriptions'),
+        url=lambda data: os.path.join(MODE_BASE_URL, data['_links']['self']['href'][5:])
+    )
+    __slots__ = tuple(FIELDS)
+
+
+class Space(Model):
+    FIELDS = _fields(
+        'id', 'name', 'space_type', 'description', 'state', 'restricted',
+        url=lambda data: os.path.join(MODE_BASE_URL, data['_links']['self']['href'][5:])
+    )
+    __slots__ = tuple(FIELDS)
+
+
+class Definition(Model):
+    FIELDS = _fields(
+        'id', 'name', 'created_at', 'data_source_id', 'description', 'source', 'token',
+        creator=_link('creator', start=5),
+        url=PROVIDED
+    )
+    __slots__ = tuple(FIELDS)
+
+
+class Connection(Model):
+    FIELDS = _fields(
+        'id', 'name', 'account_id', 'account_username', 'adapter', 'asleep', 'bridged', 'created_at',
+        'custom_attributes', 'database', 'default', 'default_for_organization_id', 'description',
+        'display_name', 'has_expensive_schema_updates', 'host', 'ldap', 'organization_token', 'port',
+        'provider', 'public', 'queryable', 'ssl', 'token', 'updated_at', 'username', 'vendor', 'warehouse',
+        url=PROVIDED
+    )
+    __slots__ = tuple(FIELDS)
+
+
+class Organization(Model):
+    FIELDS = _fields(
+        'id', 'name', 'token', 'user', 'username', 'plan_code', 'private_definition_count',
+        'private_definition_limit', 'space_count', 'trial_state',
+        url=PROVIDED
+    )
+    __slots__ = tuple(FIELDS)
+
+
+class User(Model):
+    FIELDS = _fields(
+        'id', 'name', 'token', 'user', 'username',
+        email=lambda data: data.get('email', ''),
+        email_verified=lambda data: data.get('email_verified', ''),
+        url=PROVIDED
+    )
+    __slots__ = tuple(FIELDS)
+
+
+class Membership(Model):
+    FIELDS = _fields(
+        'admin', 'limited',
+        token=_link('self', split='/memberships/', index=1)
+    )
+    __slots__ = tuple(FIELDS)
+
+
+def payload_to_dict(payload):
+    """
+    Convert the models of an enriched payload to plain dictionaries, e.g.
+    to serialize it.
+
+    """
+    return dict(
+        (key, value.to_dict() if isinstance(value, Model) else value)
+        for key, value in payload.items()
+    )
+
+
+@ht.traced
+def get_report_run_info(url, report_run_data=None):
     """
     Retrieve the details of a report run.
 
     """
-    report_run_data = _mode_api_get(url)
-    results = _mode_api_get(url + '/results/content.json')
+    if report_run_data is None:
+        report_run_data = _mode_api_get(url)
+    results = _optional_section('results', [], _mode_api_get, url + '/results/content.json')
 
     return {
-        'report_run': {
-            'executed_by': report_run_data['_links']['executed_by']['href'].split('/')[2],
-            'account': report_run_data['_links']['account'],
-            'share': report_run_data['_links']['share'],
-            'report': report_run_data['_links']['report'],
-            'query_runs': report_run_data['_links']['query_runs'],
-            'python_cell_runs': report_run_data['_links']['python_cell_runs'],
-            'state': report_run_data['state'],
-            'parameters': report_run_data['parameters'],
-            'python_state': report_run_data['python_state'],
-            'created_at': report_run_data['created_at'],
-            'completed_at': report_run_data['completed_at'],
-            'form_fields': report_run_data['form_fields'],
-            'execution_duration': report_run_duration(report_run_data['created_at'],
-                                                      report_run_data['completed_at']),
-            'token': report_run_data['token'],
-            'results': results,
-            'url': report_run_data['_links']['web_external_url']['href'].split('?')[0]
-        }
+        'report_run': ReportRun(report_run_data, results=results)
     }
 
 
-def get_report_info(url):
+@ht.traced
+def get_report_info(url, data=None):
     """
     Retrieve the details of a report.
 
     """
-    data = _mode_api_get(url)
+    if data is None:
+        data = _mode_api_get(url)
 
     return {
-        'report': {
-            'name': data['name'],
-            'id': data['id'],
-            'creator': data['_links']['creator']['href'].split('/')[2],
-            'created_at': data['created_at'],
-            'edited_at': data['edited_at'],
-            'theme_id': data['theme_id'],
-            'archived': data['archived'],
-            'account_id': data['account_id'],
-            'account_username': data['account_username'],
-            'full_width': data['full_width'],
-            'manual_run_disabled': data['manual_run_disabled'],
-            'run_privately': data['run_privately'],
-            'is_embedded': data['is_embedded'],
-            'is_signed': data['is_signed'],
-            'shared': data['shared'],
-            'last_successfully_run_at': data['last_successfully_run_at'],
-            'consecutive_run_failures': consecutive_run_failures(url),
-            'last_successful_run_token': data['last_successful_run_token'],
-            'last_run_at': data['last_run_at'],
-            'description': data['description'],
-            'report_schedules': data['_links']['report_schedules'],
-            'report_subscriptions': data['_links']['report_subscriptions'],
-            'public': data['public'],
-            'account_id': data['account_id'],
-            'url': os.path.join(MODE_BASE_URL, data['_links']['self']['href'][5:]),
-            'space_token': data['space_token'],
-            'web_preview_image': data['web_preview_image']
-        }
+        'report': Report(data, consecutive_run_failures=_optional_section('consecutive_run_failures', None,
+                                                                          consecutive_run_failures, url))
     }
 
 
-def get_space_info(url):
+@ht.traced
+def get_space_info(url, space_data=None):
     """
     Retrieve details about a space.
 
     """
-    space_data = _mode_api_get(url)
+    if space_data is None:
+        space_data = _mode_api_get_entity(url)
 
     return {
-        'space': {
-            'id': space_data['id'],
-            'name': space_data['name'],
-            'space_type': space_data['space_type'],
-            'description': space_data['description'],
-            'state': space_data['state'],
-            'url': os.path.join(MODE_BASE_URL, space_data['_links']['self']['href'][5:]),
-            'restricted': space_data['restricted']
-        }
+        'space': Space(space_data)
     }
 
 
+@ht.traced
 def get_definition_info(url):
     """
     Retrieve details about a definition.
@@ -245,166 +850,162 @@ def get_definition_info(url):
     definition_data = _mode_api_get(url)
 
     return {
-        'definition': {
-            'id': definition_data['id'],
-            'name': definition_data['name'],
-            'created_at': definition_data['created_at'],
-            'data_source_id': definition_data['data_source_id'],
-            'description': definition_data['description'],
-            'source': definition_data['source'],
-            'token': definition_data['token'],
-            'creator': definition_data['_links']['creator']['href'][5:],
-            'url': os.path.join(MODE_BASE_URL, 'editor', url.org, 'definitions', definition_data['token'])
-        }
+        'definition': Definition(
+            definition_data,
+            url=os.path.join(MODE_BASE_URL, 'editor', url.org, 'definitions', definition_data['token'])
+        )
     }
 
 
+@ht.traced
 def get_connection_info(url):
     """
     Retrieve data about a connection.
 
     """
-    connection_data = _mode_api_get(url)
+    connection_data = _mode_api_get_entity(url)
 
     return {
-        'connection': {
-            'id': connection_data['id'],
-            'name' : connection_data['name'],
-            'account_id': connection_data['account_id'],
-            'account_username': connection_data['account_username'],
-            'adapter': connection_data['adapter'],
-            'asleep': connection_data['asleep'],
-            'bridged': connection_data['bridged'],
-            'created_at': connection_data['created_at'],
-            'custom_attributes': connection_data['custom_attributes'],
-            'database': connection_data['database'],
-            'default': connection_data['default'],
-            'default_for_organization_id': connection_data['default_for_organization_id'],
-            'description': connection_data['description'],
-            'display_name': connection_data['display_name'],
-            'has_expensive_schema_updates': connection_data['has_expensive_schema_updates'],
-            'host': connection_data['host'],
-            'ldap': connection_data['ldap'],
-            'organization_token': connection_data['organization_token'],
-            'port': connection_data['port'],
-            'provider': connection_data['provider'],
-            'public': connection_data['public'],
-            'queryable': connection_data['queryable'],
-            'ssl': connection_data['ssl'],
-            'token': connection_data['token'],
-            'updated_at': connection_data['updated_at'],
-            'username': connection_data['username'],
-            'vendor': connection_data['vendor'],
-            'warehouse': connection_data['warehouse'],
-            'url': url.connection_url
-        }
+        'connection': Connection(connection_data, url=url.connection_url)
     }
 
 
-def get_org_info(organization):
+@ht.traced
+def get_org_info(organization, org_data=None):
     """
     Retrieve organization metadata.
 
     """
-    org_data = _mode_api_get(os.path.join(MODE_BASE_URL, 'api', organization))
+    if org_data is None:
+        org_data = _mode_api_get_entity(os.path.join(MODE_BASE_URL, 'api', organization))
 
     return {
-        'organization': {
-            'id': org_data['id'],
-            'name': org_data['name'],
-            'token': org_data['token'],
-            'user': org_data['user'],
-            'username': org_data['username'],
-            'plan_code': org_data['plan_code'],
-            'private_definition_count': org_data['private_definition_count'],
-            'private_definition_limit': org_data['private_definition_limit'],
-            'space_count': org_data['space_count'],
-            'trial_state': org_data['trial_state'],
-            'url': os.path.join(MODE_BASE_URL, organization)
-        }
+        'organization': Organization(org_data, url=os.path.join(MODE_BASE_URL, organization))
     }
 
 
-def get_user_info(username):
+@ht.traced
+def get_user_info(username, user_data=None):
     """
     Retrieve info about a user.
 
     """
-    user_data = _mode_api_get(os.path.join(MODE_BASE_URL, 'api', username))
+    if user_data is None:
+        user_data = _mode_api_get_entity(os.path.join(MODE_BASE_URL, 'api', username))
 
     return {
-        'user': {
-            'email': user_data.get('email', ''),
-            'email_verified': user_data.get('email_verified', ''),
-            'id': user_data['id'],
-            'name': user_data['name'],
-            'token': user_data['token'],
-            'user': user_data['user'],
-            'username': user_data['username'],
-            'url': os.path.join(MODE_BASE_URL, username)
-        }
+        'user': User(user_data, url=os.path.join(MODE_BASE_URL, username))
     }
 
 
+@ht.traced
 def get_membership_info(url):
     """
     Retrieve a membership.
 
     """
-    membership_data = _mode_api_get(os.path.join(MODE_BASE_URL, 'api', url.org, 'memberships', url.member_token))
+    membership_data = _mode_api_get_entity(os.path.join(MODE_BASE_URL, 'api', url.org, 'memberships', url.member_token),
+                                           embed=('user', 'organization'))
 
     links = membership_data['_links']
     organization = links['organization']['href'][5:]
     username = links['user']['href'][5:]
-    membership_token = links['self']['href'].split('/memberships/')[1]
 
     membership_info = {
-        'membership': {
-            'admin': membership_data['admin'],
-            'limited': membership_data['limited'],
-            'token': membership_token
-        }
+        'membership': Membership(membership_data)
     }
 
     # Grab User Information
-    membership_info.update(get_user_info(username))
+    membership_info.update(get_user_info(username, _embedded(membership_data, 'user')))
 
     # Grab Organization Information
-    membership_info.update(get_org_info(organization))
+    membership_info.update(get_org_info(organization, _embedded(membership_data, 'organization')))
 
     return membership_info
 
 
-def enrich_payload(event_name, event_url):
+def _space_section(event_url, space_token, report_data):
+    """
+    Retrieve the space of a report, unless it was dropped to meet the
+    deadline.
+
+    """
+    space_endpoint_url = os.path.join(MODE_BASE_URL, 'api', event_url.org, 'spaces', space_token)
+    space_data = _embedded(report_data, 'space')
+
+    if space_data is not None:
+        return get_space_info(space_endpoint_url, space_data)
+
+    return _optional_section('space', {}, get_space_info, space_endpoint_url)
+
+
+@ht.traced
+def enrich_payload(event_name, event_url, deadline=None):
     """
     Use the Mode API to load details about the event.
 
+    When a `Deadline` is given, every Mode API call is bounded by the time
+    left and optional sections (query results, consecutive run failures and
+    space details) are skipped near the deadline. The skipped sections are
+    listed in the payload's `dropped_sections`.
+
     """
+    # Every Mode API call is made with the client of the event's organization
+    _event.org = EventURL(event_url).org
+    _event.deadline = deadline
+    _event.dropped_sections = []
+
+    try:
+        payload = _enrich_payload(event_name, event_url)
+    finally:
+        _event.org = None
+        _event.deadline = None
+
+    payload['dropped_sections'] = _event.dropped_sections
+
+    if payload['dropped_sections']:
+        log.warning('Dropped {} from {} event to meet the deadline'.format(', '.join(payload['dropped_sections']), event_name))
+
+    return payload
+
+
+def _enrich_payload(event_name, event_url):
     event_url = EventURL(event_url)
     scope = WEBHOOK_EVENTS[event_name]['scope']
 
+    # Resolve spaces, members and connections from the entity index,
+    # refreshed in the background every `prefetch_max_age` seconds
+    if os.environ.get('prefetch_max_age'):
+        warm_entity_index(event_url.org, float(os.environ['prefetch_max_age']))
+
+    # Prefetch calls are logged separately, only count the event's own calls
+    reset_api_call_count()
+
     if scope == 'report_run':
         #
         # Enrich a report run
         #
-        payload = get_report_run_info(event_url)
+        report_run_data = _mode_api_get(event_url, embed=('report',))
+        payload = get_report_run_info(event_url, report_run_data)
 
         # Get Report Information
-        payload.update(get_report_info(event_url.report_url))
+        report_data = _embedded(report_run_data, 'report')
+        if report_data is None:
+            report_data = _mode_api_get(event_url.report_url, embed=('space',))
+        payload.update(get_report_info(event_url.report_url, report_data))
 
         # Get Space Information
-        space_endpoint_url = os.path.join(MODE_BASE_URL, 'api', event_url.org, 'spaces', payload['report']['space_token'])
-        payload.update(get_space_info(space_endpoint_url))
+        payload.update(_space_section(event_url, payload['report']['space_token'], report_data))
 
     elif scope == 'report':
         #
         # Enrich a report
         #
-        payload = get_report_info(event_url)
+        report_data = _mode_api_get(event_url, embed=('space',))
+        payload = get_report_info(event_url, report_data)
 
         # Get Space Information
-        space_endpoint_url = os.path.join(MODE_BASE_URL, 'api', event_url.org, 'spaces', payload['report']['space_token'])
-        payload.update(get_space_info(space_endpoint_url))
+        payload.update(_space_section(event_url, payload['report']['space_token'], report_data))
 
     elif scope == 'membership':
         #
@@ -424,4 +1025,6 @@ def enrich_payload(event_name, event_url):
         #
         payload = get_definition_info(event_url)
 
+    log.info('Enriched {} event with {} Mode API call(s)'.format(event_name, api_call_count()))
+
     return payload
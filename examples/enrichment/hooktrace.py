@@ -0,0 +1,241 @@
+"""
+This module records tracing spans around the stages of a webhook
+invocation (parsing, enrichment and each Mode API call, building and
+posting the message) and writes them as JSON lines to the `hooktrace`
+logger, so the traces can be assembled offline from the logs:
+
+    {"trace_id": ..., "span_id": ..., "parent_id": ..., "name": "get_report_info",
+     "start": 1500000000.0, "duration_ms": 112.5, "error": null, ...}
+
+Invocations slower than the `profile_threshold_ms` environment variable are
+also profiled by sampling the call stacks of the invoking thread and of the
+threads it started (e.g. the `fan_out` sink threads). The sampler only
+starts once an invocation has run for longer than the threshold, so fast
+invocations pay nothing for it. Set the `tracing` environment variable to `off` to disable
+the spans.
+
+"""
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+from functools import wraps
+
+
+log = logging.getLogger('hooktrace')
+log.setLevel(logging.INFO)
+
+
+TRACING = os.environ.get('tracing', 'on') != 'off'
+
+# Seconds between two samples of a slow invocation's call stack
+PROFILE_INTERVAL = 0.005
+
+# Number of distinct call stacks reported for a slow invocation
+PROFILE_MAX_STACKS = 50
+
+_local = threading.local()
+
+
+def _new_id():
+    return uuid.uuid4().hex[:16]
+
+
+class Span(object):
+    """
+    A timed stage of an invocation.
+
+    """
+
+    def __init__(self, name, trace_id, parent_id=None, **attributes):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = _new_id()
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.start = time.time()
+        self.duration_ms = None
+        self.error = None
+
+    def to_dict(self):
+        record = dict(self.attributes)
+        record.update({
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'start': self.start,
+            'duration_ms': self.duration_ms,
+            'error': self.error
+        })
+
+        return record
+
+
+def log_exporter(record):
+    """
+    Write a span, or a profile, as a JSON line to the `hooktrace` logger.
+
+    """
+    log.info(json.dumps(record, default=str))
+
+
+EXPORTERS = [log_exporter]
+
+
+def export(record):
+    for exporter in EXPORTERS:
+        exporter(record)
+
+
+def current_span():
+    """
+    Return the innermost open span of this thread, if any.
+
+    """
+    stack = getattr(_local, 'stack', None)
+    return stack[-1] if stack else None
+
+
+@contextmanager
+def span(name, parent=None, trace_id=None, **attributes):
+    """
+    Time the enclosed block as a span, nested under the current span of
+    this thread, or under `parent` when given (e.g. a span of another
+    thread).
+
+    """
+    if not TRACING:
+        yield None
+        return
+
+    if parent is None:
+        parent = current_span()
+
+    if parent is not None:
+        trace_id = parent.trace_id
+
+    current = Span(name, trace_id or _new_id(), parent.span_id if parent else None, **attributes)
+
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    _local.stack.append(current)
+
+    try:
+        yield current
+    except Exception as error:
+        current.error = str(error)
+        raise
+    finally:
+        current.duration_ms = (time.time() - current.start) * 1000
+        _local.stack.pop()
+        export(current.to_dict())
+
+
+def traced(func):
+    """
+    Decorate a function to record every call as a span.
+
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with span(func.__name__):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+class SlowInvocationProfiler(object):
+    """
+    Sample the call stacks of the current thread, and of the threads started
+    while the block runs, once it has been running for longer than
+    `threshold` seconds, and export the most frequent stacks when the block
+    exits. Stacks are prefixed with the name of their thread.
+
+    Threads that existed before the block, other than the current one, are
+    not sampled, so threads reused from a pool started earlier are missed.
+
+    """
+
+    def __init__(self, threshold, interval=PROFILE_INTERVAL):
+        self.threshold = threshold
+        self.interval = interval
+        self.samples = Counter()
+
+    def __enter__(self):
+        self.start = time.time()
+        self.thread_id = threading.current_thread().ident
+        self._existing = set(sys._current_frames()) - {self.thread_id}
+        self.trace_span = current_span()
+        self._done = threading.Event()
+        self._sampler = threading.Thread(target=self._sample)
+        self._sampler.daemon = True
+        self._sampler.start()
+        return self
+
+    def _sample(self):
+        # Nothing is sampled for invocations faster than the threshold
+        if self._done.wait(self.threshold):
+            return
+
+        sampler_id = threading.current_thread().ident
+
+        while not self._done.is_set():
+            names = dict((thread.ident, thread.name) for thread in threading.enumerate())
+
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id in self._existing or thread_id == sampler_id:
+                    continue
+
+                stack = []
+
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('{}:{}:{}'.format(os.path.basename(code.co_filename), code.co_name, frame.f_lineno))
+                    frame = frame.f_back
+
+                stack.append(names.get(thread_id, str(thread_id)))
+                self.samples[';'.join(reversed(stack))] += 1
+
+            self._done.wait(self.interval)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._done.set()
+        self._sampler.join()
+
+        if self.samples:
+            export({
+                'trace_id': self.trace_span.trace_id if self.trace_span else None,
+                'name': 'profile',
+                'start': self.start,
+                'duration_ms': (time.time() - self.start) * 1000,
+                'threshold_ms': self.threshold * 1000,
+                'samples': sum(self.samples.values()),
+                'stacks': dict(self.samples.most_common(PROFILE_MAX_STACKS))
+            })
+
+        return False
+
+
+@contextmanager
+def invocation(name, context=None):
+    """
+    Trace a whole Lambda invocation as the root span, using the Lambda
+    request ID as the trace ID, and profile it when it is slower than
+    `profile_threshold_ms`.
+
+    """
+    trace_id = getattr(context, 'aws_request_id', None)
+    threshold_ms = os.environ.get('profile_threshold_ms')
+
+    with span(name, trace_id=trace_id) as root:
+        if threshold_ms:
+            with SlowInvocationProfiler(float(threshold_ms) / 1000):
+                yield root
+        else:
+            yield root